@@ -1,8 +1,16 @@
+import os
+# Force IPv4 for LSL (works on all pylsl versions). liblsl reads these when it is
+# loaded, so they must be set before pylsl (or psychopy) is imported
+os.environ['LSL_IPV4'] = 'allow'  # Bypass IPv6 completely
+os.environ['LSL_LOCALHOST'] = '127.0.0.1'  # Explicit local binding
+
 from psychopy import visual, core, event, data, gui
+from psychopy.hardware import keyboard
 import random
 import pandas as pd
 import numpy as np
 import threading
+import collections
 from pylsl import StreamInfo, StreamOutlet
 import pylsl  # Add this line to access pylsl.local_clock
 # Get LSL version info (works on all versions)
@@ -14,15 +22,8 @@ try:
     from pylsl import get_config
     print(f"IPv6 support: {get_config('ipv6')}")
 except ImportError:
-    # Fallback for older versions
+    # Fallback for older versions; IPv4 mode is already forced above
     print("IPv6 status: Unknown (pylsl too old for config check)")
-    print("Forcing IPv4 compatibility...")
-    import os
-    os.environ['LSL_IPV4'] = 'allow'  # Force IPv4 mode
-import os
-# Force IPv4 for LSL (works on all pylsl versions)
-os.environ['LSL_IPV4'] = 'allow'  # Bypass IPv6 completely
-os.environ['LSL_LOCALHOST'] = '127.0.0.1'  # Explicit local binding
 
 # Set up experiment info
 exp_info = {
@@ -38,15 +39,16 @@ class ResilientOutlet:
     def __init__(self):
         self.outlet = None
         self.last_successful_send = 0  # Critical initialization
-        self.lock = threading.Lock()   # Thread safety
+        self.recovery_lock = threading.Lock()  # Serializes outlet re-creation only
         self.info = StreamInfo(
             name='StroopMarkers',
             type='Markers',
             channel_count=1,
             nominal_srate=0,
             channel_format='string',
-            source_id=f'stroop_{exp_info["participant"]}'
+            source_id=unique_id  # Participant is still empty here; keep one stable ID per run
         )
+        # Metadata is written once; create_outlet reuses self.info on reconnect
         channels = self.info.desc().append_child("channels")
         channels.append_child("channel").append_child_value("label", "Markers")
         self.info.desc().append_child_value("manufacturer", "PsychoPy")
@@ -68,25 +70,27 @@ class ResilientOutlet:
     
     def push_sample(self, marker, timestamp=None):
         """Wrapper with auto-recovery"""
-        with self.lock:  # Thread-safe
-            if timestamp is None:
-                timestamp = pylsl.local_clock()
-            
-            if isinstance(marker, (list, tuple)):
-                marker = marker[0] if len(marker) > 0 else ""
-            marker_str = str(marker)
+        # StreamOutlet.push_sample is thread-safe in liblsl, so the fast path
+        # takes no lock; only outlet recovery is serialized
+        if timestamp is None:
+            timestamp = pylsl.local_clock()
+        
+        if isinstance(marker, (list, tuple)):
+            marker = marker[0] if len(marker) > 0 else ""
+        marker_str = str(marker)
+        
+        try:
+            if self.outlet:
+                self.outlet.push_sample([marker_str], timestamp)
+                self.last_successful_send = time.time()
+                return True
+        except Exception as e:
+            current_time = time.time()
+            time_since_last = current_time - self.last_successful_send
+            print(f"⚠️ Marker '{marker_str}' failed: {str(e)}. Time since last success: {time_since_last:.2f}s")
             
-            try:
-                if self.outlet:
-                    self.outlet.push_sample([marker_str], timestamp)
-                    self.last_successful_send = time.time()
-                    return True
-            except Exception as e:
-                current_time = time.time()
-                time_since_last = current_time - self.last_successful_send
-                print(f"⚠️ Marker '{marker_str}' failed: {str(e)}. Time since last success: {time_since_last:.2f}s")
-                
-                if time_since_last > 3.0:  
+            if time_since_last > 3.0:
+                with self.recovery_lock:
                     print("Attempting outlet recovery...")
                     if self.create_outlet():
                         try:
@@ -96,7 +100,34 @@ class ResilientOutlet:
                                 return True
                         except Exception as e2:
                             print(f"⚠️ Recovery failed for '{marker_str}': {str(e2)}")
-            return False
+        return False
+
+    def push_chunk(self, markers, timestamps):
+        """Push several markers in a single LSL call, with the same auto-recovery"""
+        chunk = [[str(marker)] for marker in markers]
+        
+        try:
+            if self.outlet:
+                self.outlet.push_chunk(chunk, timestamps)
+                self.last_successful_send = time.time()
+                return True
+        except Exception as e:
+            current_time = time.time()
+            time_since_last = current_time - self.last_successful_send
+            print(f"⚠️ Chunk {markers} failed: {str(e)}. Time since last success: {time_since_last:.2f}s")
+            
+            if time_since_last > 3.0:
+                with self.recovery_lock:
+                    print("Attempting outlet recovery...")
+                    if self.create_outlet():
+                        try:
+                            if self.outlet:
+                                self.outlet.push_chunk(chunk, timestamps)
+                                self.last_successful_send = time.time()
+                                return True
+                        except Exception as e2:
+                            print(f"⚠️ Recovery failed for chunk {markers}: {str(e2)}")
+        return False
 
 # Replace your outlet creation with:
 outlet = ResilientOutlet()
@@ -110,44 +141,104 @@ if outlet.outlet:
 else:
     print("Warning: No LSL outlet created")
 
-def send_event_code(outlet, code, description="", max_retries=3):
-    """Send an event code with description and guarantee delivery"""
-    timestamp = pylsl.local_clock()
-    code_str = f"CODE_{code:03d}"
-    
+class MarkerRing:
+    """Single-producer/single-consumer ring buffer of pending markers"""
+    def __init__(self, size=1024):
+        assert size & (size - 1) == 0, "size must be a power of two"
+        self.buffer = [None] * size
+        self.mask = size - 1  # Indices wrap with a bit mask instead of modulo
+        self.head = 0  # Next slot to read (sender thread only)
+        self.tail = 0  # Next slot to write (experiment thread only)
+    
+    def push(self, item):
+        if self.tail - self.head > self.mask:
+            return False  # Full: drop rather than block the experiment
+        self.buffer[self.tail & self.mask] = item
+        self.tail += 1
+        return True
+    
+    def pop(self):
+        if self.head == self.tail:
+            return None
+        slot = self.head & self.mask
+        item = self.buffer[slot]
+        self.buffer[slot] = None
+        self.head += 1
+        return item
+
+# Markers are queued by the experiment thread and pushed by a background sender,
+# so LSL stalls and retries never block stimulus presentation
+marker_queue = MarkerRing(1024)
+
+# Marker strings for every possible code, so sending does no string formatting
+CODE_STR = [f"CODE_{i:03d}" for i in range(1000)]
+marker_ready = threading.Event()
+stop_event = threading.Event()
+KEEPALIVE_INTERVAL = 5.0  # seconds between keepalive markers
+
+def push_event_code(outlet, code_str, description, timestamp, max_retries=3):
+    """Push a code/description pair, retrying on failure (blocking)"""
     success = False
     for attempt in range(max_retries):
         try:
-            # Send both markers with proper encoding
-            outlet.push_sample(code_str, timestamp)
-            outlet.push_sample(description, timestamp + 0.001)
-            print(f"✓ Sent {code_str}: {description}")
-            success = True
-            break
+            # Send code and description together in one chunk (one LSL call)
+            if outlet.push_chunk([code_str, description], [timestamp, timestamp + 0.001]):
+                print(f"✓ Sent {code_str}: {description}")
+                success = True
+                break
+            print(f"⚠️ Send failed (attempt {attempt+1}/{max_retries})")
         except Exception as e:
             print(f"⚠️ Send failed (attempt {attempt+1}/{max_retries}): {str(e)}")
-            if attempt < max_retries-1:
-                core.wait(0.5)
+        if attempt < max_retries-1:
+            time.sleep(0.5)
     
     if not success:
-        print(f"❌ Failed to send code {code}: {description} after {max_retries} attempts")
+        print(f"❌ Failed to send {code_str}: {description} after {max_retries} attempts")
     return success
 
-# ===== ADD STEP 4 HERE =====
-def send_keepalive(outlet):
-    """Send periodic keepalive markers every 5 seconds"""
+def send_event_code(outlet, code, description=""):
+    """Queue an event code with description for the sender thread (non-blocking)"""
+    # Timestamp is taken here, at the call site, not when the marker is pushed
+    queued = marker_queue.push((CODE_STR[code], description, pylsl.local_clock()))
+    marker_ready.set()
+    if not queued:
+        print(f"❌ Marker queue full, dropped code {code}: {description}")
+    return queued
+
+def marker_sender(outlet):
+    """Drain queued markers and push them to LSL, with periodic keepalive markers"""
+    next_keepalive = time.time() + KEEPALIVE_INTERVAL
     while True:
-        outlet.push_sample("KEEPALIVE")
-        time.sleep(5.0)
-
-# Start keepalive thread
-keepalive_thread = threading.Thread(
-    target=send_keepalive, 
-    args=(outlet,), 
+        # Sleep until a marker is queued, shutdown is requested or a keepalive is due
+        marker_ready.wait(max(0, next_keepalive - time.time()))
+        marker_ready.clear()
+        item = marker_queue.pop()
+        while item is not None:
+            code_str, description, timestamp = item
+            push_event_code(outlet, code_str, description, timestamp)
+            item = marker_queue.pop()
+        
+        if stop_event.is_set():
+            break
+        if time.time() >= next_keepalive:
+            outlet.push_sample("KEEPALIVE")
+            next_keepalive = time.time() + KEEPALIVE_INTERVAL
+
+# Start marker sender thread
+sender_thread = threading.Thread(
+    target=marker_sender,
+    args=(outlet,),
     daemon=True
 )
-keepalive_thread.start()
-# ===== END STEP 4 ADDITION =====
+sender_thread.start()
+
+def stop_sender():
+    """Wake the sender so it pushes every queued marker and exits (call before quitting)"""
+    stop_event.set()
+    marker_ready.set()
+    if sender_thread.is_alive():
+        print("Waiting for marker sender to finish...")
+        sender_thread.join(timeout=2.0)
 
 # Send initialization pulses
 try:
@@ -158,18 +249,14 @@ try:
         if not outlet.outlet:
             print("❌ Failed to create LSL outlet. Continuing without LSL markers.")
     
-    # Send initialization codes with logging
+    # Send all initialization codes in one chunk, so they either all land or none do
     print("Sending system initialization codes...")
-    init_success = send_event_code(outlet, 900, 'SYSTEM_INIT')
-    core.wait(0.5)  # Add delay between critical markers
-    
-    nirx_success = send_event_code(outlet, 901, 'NIRX_CONNECT')
-    core.wait(0.5)  # Add delay between critical markers
-    
-    aurora_success = send_event_code(outlet, 902, 'AURORA_READY')
+    init_markers = [CODE_STR[900], 'SYSTEM_INIT', CODE_STR[901], 'NIRX_CONNECT', CODE_STR[902], 'AURORA_READY']
+    t0 = pylsl.local_clock()
+    init_success = outlet.push_chunk(init_markers, [t0 + i*0.001 for i in range(len(init_markers))])
     
     # ✅ Only proceed if all codes were sent successfully
-    if init_success and nirx_success and aurora_success:
+    if init_success:
         print("✓ System initialization sequence complete")
         core.wait(2.0)  # Buffer time for devices to initialize
     else:
@@ -189,14 +276,18 @@ win = visual.Window([800, 600], color="black", units="pix", fullscr=True)
 
 background = visual.Rect(win, width=800, height=600, fillColor="black", lineColor=None)
 
+# Hardware keyboard (PTB backend) for escape checks; keys are collected on its own thread
+kb = keyboard.Keyboard(backend='ptb')
+
 # Test LSL connection before starting experiment
 print("Testing LSL connection...")
 test_success = True
 for i in range(5):
-    if not send_event_code(outlet, 800+i, f'TEST_LSL_{i}'):
+    # Pushed synchronously so the test reflects actual delivery
+    if not push_event_code(outlet, CODE_STR[800+i], f'TEST_LSL_{i}', pylsl.local_clock()):
         test_success = False
         break
-    core.wait(0.1)
+    core.wait(0.1, hogCPUperiod=0)
 
 if test_success:
     print("✓ LSL connection test passed")
@@ -246,8 +337,9 @@ color_schemes = {
 fixation = visual.TextStim(win, text="+", color="white", height=40)
 neutral_stim = visual.TextStim(win, text="◯", color="white", height=40)
 
-# Define Stroop stimuli conditions
-conditions = pd.DataFrame([
+# Define Stroop stimuli conditions as plain tuples (pandas is only used for saving data)
+Condition = collections.namedtuple("Condition", ["stimulus", "correct_response", "congruent", "condition_name"])
+conditions = [Condition(*row) for row in [
     ["yellowyellow", "y", 1, "yellow yellow"], 
     ["yellowgreen", "g", 0, "yellow green"], 
     ["yellowblue", "b", 0, "yellow blue"], 
@@ -264,11 +356,35 @@ conditions = pd.DataFrame([
     ["bluegreen", "g", 0, "blue green"], 
     ["blueblue", "b", 1, "blue blue"], 
     ["bluered", "r", 0, "blue red"]
-], columns=["stimulus", "correct_response", "congruent", "condition_name"])
+]]
 
-# Separate congruent and incongruent conditions
-congruent_conditions = conditions[conditions["congruent"] == 1]
-incongruent_conditions = conditions[conditions["congruent"] == 0]
+# Map each stimulus code to (word, color) from its condition name, e.g. "redblue" -> ("red", "blue")
+WORD_COLOR_SPLIT = {
+    row.stimulus: tuple(row.condition_name.split())
+    for row in conditions
+}
+
+# Build every Stroop stimulus once (4 words x 4 colors x 2 contrasts) instead of per trial
+STIM_CACHE = {}
+for word in stroop_text:
+    for color in ["red", "green", "blue", "yellow"]:
+        for contrast in ['low', 'high']:
+            STIM_CACHE[(word, color, contrast)] = visual.TextStim(
+                win,
+                text=stroop_text[word],
+                color=color_schemes[contrast][color],
+                height=80,
+                bold=True,
+                pos=[0, 0],
+                colorSpace='rgb',
+                opacity=1.0 if contrast == 'high' else 0.1  # Vivid for high contrast
+            )
+
+# Separate congruent and incongruent conditions into per-block-type trial pools
+POOLS = {
+    'congruent': [c for c in conditions if c.congruent == 1],
+    'incongruent': [c for c in conditions if c.congruent == 0]
+}
 
 # Block definitions
 block_definitions = [
@@ -291,13 +407,31 @@ block_definitions = [
 # Set up files to save results
 raw_data_file = f"stroop_high_contrast_raw_{exp_info['participant']}_{exp_info['session']}.csv"
 summary_data_file = f"stroop_high_contrast_summary_{exp_info['participant']}_{exp_info['session']}.csv"
-results = []
+
+# Results are stored column-wise (one list per field) so save_data can build
+# the DataFrame directly from columns
+RESULT_FIELDS = ('participant', 'session', 'block', 'block_type', 'contrast',
+                 'stimulus', 'response', 'correct', 'rt')
+results = {field: [] for field in RESULT_FIELDS}
+
+def record_trial(block, block_type, contrast, stimulus, response, correct, rt):
+    """Append one trial row to the column-wise results"""
+    results['participant'].append(exp_info['participant'])
+    results['session'].append(exp_info['session'])
+    results['block'].append(block)
+    results['block_type'].append(block_type)
+    results['contrast'].append(contrast)
+    results['stimulus'].append(stimulus)
+    results['response'].append(response)
+    results['correct'].append(correct)
+    results['rt'].append(rt)
 
 def check_for_escape():
-    keys = event.getKeys(keyList=['escape'])
-    if 'escape' in keys:
-        if results:
+    keys = kb.getKeys(['escape'], waitRelease=False, clear=True)
+    if keys:
+        if results['block']:
             save_data(results, "partial")
+        stop_sender()
         win.close()
         core.quit()
 
@@ -306,9 +440,9 @@ def save_data(results_data, prefix=""):
     if not raw_df.empty:
         raw_df.to_csv(f"{prefix}_{raw_data_file}", index=False)
     
-    if len(results_data) > 0:
+    if not raw_df.empty:
         # Separate into different conditions
-        df_stroop = pd.DataFrame([r for r in results_data if r["block_type"] in ["congruent", "incongruent"]])
+        df_stroop = raw_df[raw_df["block_type"].isin(["congruent", "incongruent"])]
         
         results = {
             'low': {'congruent': [], 'incongruent': []},
@@ -317,31 +451,32 @@ def save_data(results_data, prefix=""):
         }
         
         if not df_stroop.empty:
-            # Process low contrast data
-            low_contrast = df_stroop[df_stroop["contrast"] == "low"]
-            low_congruent = low_contrast[low_contrast["block_type"] == "congruent"]
-            low_incongruent = low_contrast[low_contrast["block_type"] == "incongruent"]
-            
-            # Process high contrast data
-            high_contrast = df_stroop[df_stroop["contrast"] == "high"]
-            high_congruent = high_contrast[high_contrast["block_type"] == "congruent"]
-            high_incongruent = high_contrast[high_contrast["block_type"] == "incongruent"]
+            # Aggregate every contrast/block-type condition in a single grouped pass
+            df_stroop = df_stroop.assign(correct=df_stroop["correct"].astype(bool))
+            df_stroop = df_stroop.assign(rt_correct=df_stroop["rt"].where(df_stroop["correct"]))
+            grouped = df_stroop.groupby(["contrast", "block_type"]).agg(
+                count=("correct", "size"),
+                correct=("correct", "sum"),
+                mean_rt=("rt_correct", "mean")
+            )
             
             # Calculate metrics for each condition
-            def calculate_metrics(condition_df, condition_name):
-                correct_trials = condition_df[condition_df["correct"] == True]
+            def calculate_metrics(contrast, block_type):
+                if (contrast, block_type) not in grouped.index:
+                    return {'count': 0, 'correct': 0, 'accuracy': 0, 'mean_rt': float('nan')}
+                row = grouped.loc[(contrast, block_type)]
                 return {
-                    'count': len(condition_df),
-                    'correct': len(correct_trials),
-                    'accuracy': len(correct_trials)/len(condition_df) if len(condition_df) > 0 else 0,
-                    'mean_rt': correct_trials["rt"].mean() if not correct_trials.empty else float('nan')
+                    'count': int(row['count']),
+                    'correct': int(row['correct']),
+                    'accuracy': row['correct']/row['count'],
+                    'mean_rt': row['mean_rt']
                 }
             
             metrics = {
-                'low_congruent': calculate_metrics(low_congruent, "low_congruent"),
-                'low_incongruent': calculate_metrics(low_incongruent, "low_incongruent"),
-                'high_congruent': calculate_metrics(high_congruent, "high_congruent"),
-                'high_incongruent': calculate_metrics(high_incongruent, "high_incongruent")
+                'low_congruent': calculate_metrics("low", "congruent"),
+                'low_incongruent': calculate_metrics("low", "incongruent"),
+                'high_congruent': calculate_metrics("high", "congruent"),
+                'high_incongruent': calculate_metrics("high", "incongruent")
             }
             
             # Calculate Stroop effects
@@ -350,30 +485,34 @@ def save_data(results_data, prefix=""):
                 'high': metrics['high_incongruent']['mean_rt'] - metrics['high_congruent']['mean_rt']
             }
             
-            # Create summary data
-            summary_data = {
-                "measure": [
-                    "participant_id", "session",
+            # Create summary data: identifiers first, then a homogeneous float64 block of metrics
+            id_df = pd.DataFrame({
+                "measure": ["participant_id", "session"],
+                "value": [exp_info['participant'], exp_info['session']]
+            })
+            metrics_df = pd.DataFrame({
+                "measure": np.array([
                     "low_contrast_congruent_trials", "low_contrast_congruent_correct", "low_contrast_congruent_accuracy", "low_contrast_congruent_mean_rt",
                     "low_contrast_incongruent_trials", "low_contrast_incongruent_correct", "low_contrast_incongruent_accuracy", "low_contrast_incongruent_mean_rt",
                     "low_contrast_stroop_effect",
                     "high_contrast_congruent_trials", "high_contrast_congruent_correct", "high_contrast_congruent_accuracy", "high_contrast_congruent_mean_rt",
                     "high_contrast_incongruent_trials", "high_contrast_incongruent_correct", "high_contrast_incongruent_accuracy", "high_contrast_incongruent_mean_rt",
                     "high_contrast_stroop_effect"
-                ],
-                "value": [
-                    exp_info['participant'], exp_info['session'],
+                ], dtype=object),
+                "value": np.array([
                     metrics['low_congruent']['count'], metrics['low_congruent']['correct'], metrics['low_congruent']['accuracy'], metrics['low_congruent']['mean_rt'],
                     metrics['low_incongruent']['count'], metrics['low_incongruent']['correct'], metrics['low_incongruent']['accuracy'], metrics['low_incongruent']['mean_rt'],
                     stroop_effects['low'],
                     metrics['high_congruent']['count'], metrics['high_congruent']['correct'], metrics['high_congruent']['accuracy'], metrics['high_congruent']['mean_rt'],
                     metrics['high_incongruent']['count'], metrics['high_incongruent']['correct'], metrics['high_incongruent']['accuracy'], metrics['high_incongruent']['mean_rt'],
                     stroop_effects['high']
-                ]
-            }
+                ], dtype=np.float64)
+            })
             
-            summary_df = pd.DataFrame(summary_data)
-            summary_df.to_csv(f"{prefix}_{summary_data_file}", index=False)
+            # Same measure/value layout as before, written as two homogeneous blocks
+            id_df.to_csv(f"{prefix}_{summary_data_file}", index=False)
+            metrics_df.to_csv(f"{prefix}_{summary_data_file}", index=False, header=False,
+                              mode='a', float_format='%.6f')
             
             return metrics, stroop_effects
     
@@ -388,25 +527,30 @@ def generate_block_sequence():
     shuffled_stroop = []
     last_contrast = None
     contrast_counter = 0
-    remaining_stroop = stroop_blocks.copy()
+    by_contrast = {
+        'low': [b for b in stroop_blocks if b['contrast'] == 'low'],
+        'high': [b for b in stroop_blocks if b['contrast'] == 'high']
+    }
     
-    while remaining_stroop:
-        # Filter available blocks
-        available = []
-        for b in remaining_stroop:
-            if b['contrast'] != last_contrast:
-                available.append(b)
-            else:
-                if contrast_counter < 2:  # Allow up to 2 repeats
-                    available.append(b)
+    while by_contrast['low'] or by_contrast['high']:
+        # Allow up to 2 repeats, then force a contrast change if possible
+        other_contrasts = [c for c in by_contrast if c != last_contrast and by_contrast[c]]
+        if contrast_counter >= 2 and other_contrasts:
+            candidates = other_contrasts
+        else:
+            candidates = [c for c in by_contrast if by_contrast[c]]
         
-        if not available:
-            # Force contrast change if no valid options
-            available = [b for b in remaining_stroop if b['contrast'] != last_contrast]
-            
-        chosen = random.choice(available)
+        # Pick uniformly over all candidate blocks, then swap-pop it out of its bucket
+        idx = random.randrange(sum(len(by_contrast[c]) for c in candidates))
+        for contrast in candidates:
+            bucket = by_contrast[contrast]
+            if idx < len(bucket):
+                break
+            idx -= len(bucket)
+        chosen = bucket[idx]
+        bucket[idx] = bucket[-1]
+        bucket.pop()
         shuffled_stroop.append(chosen)
-        remaining_stroop.remove(chosen)
         
         # Update contrast tracking
         if chosen['contrast'] == last_contrast:
@@ -433,53 +577,32 @@ def generate_block_sequence():
 instructions1 = visual.TextStim(win, text="Welcome to the Stroop Task!\n\nIn this task, you will see color words presented in different colors.\n\nYour task is to respond to the COLOR of the text, not the word itself.\n\nPress space to continue. (Press escape at any time to exit)", color="white", wrapWidth=700)
 instructions1.draw()
 win.flip()
-event.waitKeys(keyList=["space", "escape"])
-if event.getKeys(keyList=["escape"]):
+keys = event.waitKeys(keyList=["space", "escape"])
+if "escape" in keys:
+    stop_sender()
     win.close()
     core.quit()
 
 instructions2 = visual.TextStim(win, text="Press:\nR = Red\nG = Green\nB = Blue\nY = Yellow\n\nYou will complete a full version with different conditions in them.\n\nThere will be neutral screens between blocks.\n\nPress space to start. (Press escape at any time to exit)", color="white", wrapWidth=700)
 instructions2.draw()
 win.flip()
-event.waitKeys(keyList=["space", "escape"])
-if event.getKeys(keyList=["escape"]):
+keys = event.waitKeys(keyList=["space", "escape"])
+if "escape" in keys:
+    stop_sender()
     win.close()
     core.quit()
     
 send_event_code(outlet, 0, 'experiment_start')
 
 def create_stroop_stimulus(stimulus_code, contrast):
-    for color_name in ["red", "green", "blue", "yellow"]:
-        if stimulus_code.startswith(color_name):
-            word = color_name
-            color = stimulus_code[len(word):] or word
-            break
-    
-    colors = color_schemes[contrast]
-    
-    # For high contrast, ensure colors are vivid
-    if contrast == 'high':
-        return visual.TextStim(
-            win,
-            text=stroop_text[word],
-            color=colors[color],
-            height=80,
-            bold=True,
-            pos=[0, 0],
-            colorSpace='rgb',
-            opacity=1.0
-        )
-    else:  # low contrast
-        return visual.TextStim(
-            win,
-            text=stroop_text[word],
-            color=colors[color],
-            height=80,
-            bold=True,
-            pos=[0, 0],
-            colorSpace='rgb',
-            opacity=0.1
-        )
+    word, color = WORD_COLOR_SPLIT[stimulus_code]
+    return STIM_CACHE[(word, color, contrast)]
+
+# Response marker descriptions for every key/outcome pair
+RESPONSE_DESC = {
+    (key, correct): f'response_{key}_{"correct" if correct else "incorrect"}'
+    for key in ["r", "g", "b", "y"] for correct in [True, False]
+}
 
 def run_block(block_def, block_num):
     """Run a single block with proper trial sampling and LSL markers"""
@@ -494,68 +617,67 @@ def run_block(block_def, block_num):
         win.flip()
     
         duration = random.uniform(18, 22)  # 18-22s neutral duration
-        start_time = core.getTime()
     
-        while core.getTime() - start_time < duration:
-            check_for_escape()
-            core.wait(0.1)
+        # Block for the whole neutral period, returning early only on escape
+        keys = event.waitKeys(maxWait=duration, keyList=['escape'])
+        if keys and 'escape' in keys:
+            if results['block']:
+                save_data(results, "partial")
+            stop_sender()
+            win.close()
+            core.quit()
     
         send_event_code(outlet, 350 + block_num, f'neutral_block_{block_num}_end')
-        return [{
-            "participant": exp_info['participant'],
-            "session": exp_info['session'],
-            "block": block_num,
-            "block_type": "neutral",
-            "contrast": "n/a",
-            "stimulus": "◯",  # Explicitly log the circle
-            "response": "n/a",
-            "correct": "n/a",
-            "rt": duration
-    }]
+        record_trial(block_num, "neutral", "n/a",
+                     "◯",  # Explicitly log the circle
+                     "n/a", "n/a", duration)
+        return
 
     # ===== 2. Stroop Block Setup =====
     # Get trial count (8 or 15)
     num_trials = block_def.get('trials', 8)  
     
     # Select appropriate trials
-    trials = conditions[conditions["congruent"] == (1 if block_def['type'] == 'congruent' else 0)].copy()
+    pool = POOLS[block_def['type']]
+    
+    # Sample trials with replacement (ensures we get enough even if num_trials > unique trials).
+    # Each draw skips the previous stimulus, so there are no immediate repeats by construction
+    block_trials = []
+    prev_idx = None
+    for _ in range(num_trials):
+        if prev_idx is None:
+            idx = random.randrange(len(pool))
+        else:
+            idx = random.randrange(len(pool) - 1)
+            if idx >= prev_idx:
+                idx += 1
+        block_trials.append(pool[idx])
+        prev_idx = idx
     
-    # Sample trials with replacement (ensures we get enough even if num_trials > unique trials)
-    block_trials = trials.sample(n=num_trials, replace=True).to_dict('records')
+    # Marker descriptions are formatted here, outside the trial loop
+    block_label = f"{block_def['contrast']}_{block_def['type']}_block_{block_num}"
+    trial_descriptions = [f"trial_{trial_num}_start_{trial.stimulus}"
+                          for trial_num, trial in enumerate(block_trials, 1)]
     
     # ===== 3. Block-Level Markers =====
     code_prefix = 100 if block_def['contrast'] == 'low' else 200
-    send_event_code(outlet, code_prefix + block_num, 
-                   f"{block_def['contrast']}_{block_def['type']}_block_{block_num}_start")
+    send_event_code(outlet, code_prefix + block_num, f"{block_label}_start")
     
     # ===== 4. Run Trials =====
-    block_results = []
-    prev_stimulus = None
     for trial_num, trial in enumerate(block_trials, 1):
-        resample_attempts = 0
-        while trial['stimulus'] == prev_stimulus and resample_attempts < 5:
-            trial = trials.sample(1).iloc[0].to_dict()
-            resample_attempts += 1
-        prev_stimulus = trial['stimulus']
-
-        
         # --- 4.2 Fixation ---
         background.draw()
         fixation.draw()
         win.flip()
-        core.wait(0.5)
+        # Fixation absorbs the former 100 ms blank; onset asynchrony unchanged.
+        # hogCPUperiod=0 sleeps instead of spinning, leaving the GIL to the marker sender
+        core.wait(0.6, hogCPUperiod=0)
         check_for_escape()
         
-        # --- 4.3 Blank Screen ---
-        background.draw()
-        win.flip()
-        core.wait(0.1)
-        
         # --- 4.4 Stimulus + LSL Marker ---
-        send_event_code(outlet, code_prefix + 10 + trial_num, 
-                       f"trial_{trial_num}_start_{trial['stimulus']}")
+        send_event_code(outlet, code_prefix + 10 + trial_num, trial_descriptions[trial_num-1])
         
-        stim = create_stroop_stimulus(trial['stimulus'], block_def['contrast'])
+        stim = create_stroop_stimulus(trial.stimulus, block_def['contrast'])
         background.draw()
         stim.draw()
         win.flip()
@@ -571,14 +693,15 @@ def run_block(block_def, block_num):
         # --- 4.6 Process Response ---
         if keys and keys[0][0] == 'escape':
             save_data(results, "partial")
+            stop_sender()
             win.close()
             core.quit()
             
         if keys:
             key, rt = keys[0]
-            correct = (key == trial['correct_response'])
+            correct = (key == trial.correct_response)
             response_code = code_prefix + (30 if correct else 40) + trial_num
-            send_event_code(outlet, response_code, f'response_{key}_{"correct" if correct else "incorrect"}')
+            send_event_code(outlet, response_code, RESPONSE_DESC[(key, correct)])
         else:
             key, rt, correct = "None", 2.0, False
             send_event_code(outlet, code_prefix + 50 + trial_num, 'no_response')
@@ -586,47 +709,28 @@ def run_block(block_def, block_num):
         # --- 4.7 ITI ---
         background.draw()
         win.flip()
-        core.wait(random.uniform(0.8, 1.2))
+        core.wait(random.uniform(0.8, 1.2), hogCPUperiod=0)
         check_for_escape()
         
         # --- 4.8 Save Trial Data ---
-        block_results.append({
-            "participant": exp_info['participant'],
-            "session": exp_info['session'],
-            "block": block_num,
-            "block_type": block_def['type'],
-            "contrast": block_def['contrast'],
-            "stimulus": trial['stimulus'],
-            "response": key,
-            "correct": correct,
-            "rt": rt
-        })
+        record_trial(block_num, block_def['type'], block_def['contrast'],
+                     trial.stimulus, key, correct, rt)
     
     # ===== 5. Block End Marker =====
-    send_event_code(outlet, code_prefix + 60 + block_num,
-                   f"{block_def['contrast']}_{block_def['type']}_block_{block_num}_end")
-    
-    return block_results
+    send_event_code(outlet, code_prefix + 60 + block_num, f"{block_label}_end")
 
 # Generate random sequence
 block_sequence = generate_block_sequence()
 print(f"Generated block sequence with {len(block_sequence)} blocks")
 
+# Drop key presses kb buffered during the instruction screens, so they can't trigger
+# check_for_escape() in the first block
+kb.clearEvents()
+
 # Run all blocks
 for block_num, block_def in enumerate(block_sequence, 1):
-    # Send block start marker
-    if block_def['type'] != 'neutral':
-        code_prefix = 100 if block_def['contrast'] == 'low' else 200
-        send_event_code(outlet, code_prefix + block_num, 
-                       f"{block_def['contrast']}_{block_def['type']}_start")
-    
-    # Run the block
-    results.extend(run_block(block_def, block_num))
-    
-    # Send block end marker
-    if block_def['type'] != 'neutral':
-        send_event_code(outlet, code_prefix + 50 + block_num,
-                       f"{block_def['contrast']}_{block_def['type']}_end")
+    # Block start/end markers are sent by run_block itself
+    run_block(block_def, block_num)
 
 # Display final feedback
 metrics, stroop_effects = save_data(results)
@@ -658,12 +762,9 @@ print("Shutting down LSL connection...")
 try:
     # Send final marker
     send_event_code(outlet, 999, 'EXPERIMENT_COMPLETE')
-    core.wait(1.0)  # Wait to ensure marker is sent
     
-    # Clean shutdown
-    if keepalive_thread.is_alive():
-        print("Waiting for keepalive thread to finish...")
-        keepalive_thread.join(timeout=2.0)
+    # Clean shutdown: wake the sender so it flushes remaining markers and exits
+    stop_sender()
         
     # Force outlet closure
     if hasattr(outlet, 'outlet') and outlet.outlet:
@@ -3,6 +3,13 @@ import random
 import pandas as pd
 import numpy as np
 import threading
+import queue
+import logging
+import logging.handlers
+import sys
+import csv
+import atexit
+from dataclasses import dataclass
 from pylsl import StreamInfo, StreamOutlet
 import pylsl  # Add this line to access pylsl.local_clock
 # Get LSL version info (works on all versions)
@@ -33,12 +40,23 @@ exp_info = {
 import time
 unique_id = f"stroop_{int(time.time())}"  # Unique ID based on timestamp
 
+# Marker logging goes through a queue; a QueueListener thread does the console I/O
+log = logging.getLogger("stroop")
+log.setLevel(logging.DEBUG)
+log.propagate = False
+log_queue = queue.SimpleQueue()
+log.addHandler(logging.handlers.QueueHandler(log_queue))
+log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+log_listener.start()
+atexit.register(log_listener.stop)  # Flush queued log lines on every exit, including core.quit() on escape
+
 # Enhance the ResilientOutlet class
 class ResilientOutlet:
     def __init__(self):
         self.outlet = None
         self.last_successful_send = 0  # Critical initialization
         self.lock = threading.Lock()   # Thread safety
+        self.recovering = False        # True while a background thread recreates the outlet
         self.info = StreamInfo(
             name='StroopMarkers',
             type='Markers',
@@ -65,6 +83,22 @@ class ResilientOutlet:
                 if attempt < max_attempts-1:
                     import time; time.sleep(1)
         return False
+
+    def start_recovery(self):
+        """Recreate the outlet on a helper thread so the marker thread keeps draining;
+        markers are dropped until self.outlet is set again"""
+        if self.recovering:
+            return
+        self.recovering = True
+        self.outlet = None
+        log.warning("Attempting outlet recovery in background...")
+        threading.Thread(target=self._recover, daemon=True).start()
+
+    def _recover(self):
+        try:
+            self.create_outlet()
+        finally:
+            self.recovering = False
     
     def push_sample(self, marker, timestamp=None):
         """Wrapper with auto-recovery"""
@@ -76,26 +110,43 @@ class ResilientOutlet:
                 marker = marker[0] if len(marker) > 0 else ""
             marker_str = str(marker)
             
+            outlet = self.outlet
+            if outlet is None:
+                log.warning("⚠️ No LSL outlet, dropping marker '%s'", marker_str)
+                self.start_recovery()
+                return False
             try:
-                if self.outlet:
-                    self.outlet.push_sample([marker_str], timestamp)
-                    self.last_successful_send = time.time()
-                    return True
+                outlet.push_sample([marker_str], timestamp)
+                self.last_successful_send = time.time()
+                return True
+            except Exception as e:
+                current_time = time.time()
+                time_since_last = current_time - self.last_successful_send
+                log.warning("⚠️ Marker '%s' failed: %s. Time since last success: %.2fs", marker_str, e, time_since_last)
+                
+                if time_since_last > 3.0:
+                    self.start_recovery()
+            return False
+
+    def push_chunk(self, chunk, timestamps):
+        """Push several one-channel samples ([marker] lists) in a single LSL call, with the same auto-recovery"""
+        with self.lock:  # Thread-safe
+            outlet = self.outlet
+            if outlet is None:
+                log.warning("⚠️ No LSL outlet, dropping chunk %s", chunk)
+                self.start_recovery()
+                return False
+            try:
+                outlet.push_chunk(chunk, timestamps)
+                self.last_successful_send = time.time()
+                return True
             except Exception as e:
                 current_time = time.time()
                 time_since_last = current_time - self.last_successful_send
-                print(f"⚠️ Marker '{marker_str}' failed: {str(e)}. Time since last success: {time_since_last:.2f}s")
+                log.warning("⚠️ Chunk %s failed: %s. Time since last success: %.2fs", chunk, e, time_since_last)
                 
-                if time_since_last > 3.0:  
-                    print("Attempting outlet recovery...")
-                    if self.create_outlet():
-                        try:
-                            if self.outlet:
-                                self.outlet.push_sample([marker_str], timestamp)
-                                self.last_successful_send = time.time()
-                                return True
-                        except Exception as e2:
-                            print(f"⚠️ Recovery failed for '{marker_str}': {str(e2)}")
+                if time_since_last > 3.0:
+                    self.start_recovery()
             return False
 
 # Replace your outlet creation with:
@@ -110,34 +161,81 @@ if outlet.outlet:
 else:
     print("Warning: No LSL outlet created")
 
-def send_event_code(outlet, code, description="", max_retries=3):
-    """Send an event code as a pure integer marker (string format)"""
-    timestamp = pylsl.local_clock()
+# Markers are queued by the experiment thread and pushed by a background consumer,
+# so LSL I/O and retries never block stimulus presentation
+marker_q = queue.SimpleQueue()
+
+MAX_MARKER_BATCH = 32  # Most markers pushed to LSL in one call
+STOP_MARKER = None  # Queued at shutdown; the consumer pushes everything ahead of it, then exits
+
+# Prebuilt one-channel samples for every code, reused on each push instead of
+# allocating a new str and list per marker
+MARKER_STR = {i: [str(i)] for i in range(1000)}
+
+def push_event_codes(outlet, batch, max_retries=3):
+    """Push (code, timestamp, description) events as pure integer markers in one chunk, retrying on failure"""
+    # Send codes as simple integer strings (not "CODE_XXX", just "101" etc)
+    samples = [MARKER_STR[code] for code, _, _ in batch]
+    timestamps = [timestamp for _, timestamp, _ in batch]
 
     success = False
     for attempt in range(max_retries):
         try:
-            # Send the code as a simple integer string (not "CODE_XXX", just "101" etc)
-            outlet.push_sample([str(code)], timestamp)
-            print(f"✓ Sent code {code}: {description}")  # Still print description for your logging
-            success = True
-            break
+            if outlet.push_chunk(samples, timestamps):
+                for code, _, description in batch:
+                    log.debug("✓ Sent code %s: %s", code, description)  # Still log description for your logging
+                success = True
+                break
+            log.warning("⚠️ Send failed (attempt %d/%d)", attempt+1, max_retries)
         except Exception as e:
-            print(f"⚠️ Send failed (attempt {attempt+1}/{max_retries}): {str(e)}")
-            if attempt < max_retries - 1:
-                core.wait(0.5)
+            log.warning("⚠️ Send failed (attempt %d/%d): %s", attempt+1, max_retries, e)
+        if attempt < max_retries - 1:
+            time.sleep(0.5)
 
     if not success:
-        print(f"❌ Failed to send code {code}: {description} after {max_retries} attempts")
+        for code, _, description in batch:
+            log.error("❌ Failed to send code %s: %s after %d attempts", code, description, max_retries)
 
     return success
 
+def send_event_code(outlet, code, description=""):
+    """Queue an event code for the marker thread (non-blocking)"""
+    # Timestamp is captured here, at the call site, not when the marker is pushed
+    marker_q.put((code, pylsl.local_clock(), description))
+    return True
+
+def marker_consumer(outlet):
+    """Push queued markers to LSL in batches, with retries, off the experiment thread"""
+    while True:
+        batch = [marker_q.get()]  # Block until at least one marker is queued
+        while batch[-1] is not STOP_MARKER and len(batch) < MAX_MARKER_BATCH:
+            try:
+                batch.append(marker_q.get_nowait())
+            except queue.Empty:
+                break
+        stopping = batch[-1] is STOP_MARKER
+        if stopping:
+            batch.pop()
+        if batch:
+            push_event_codes(outlet, batch)
+        if stopping:
+            return
+
+# Start marker thread
+marker_thread = threading.Thread(
+    target=marker_consumer,
+    args=(outlet,),
+    daemon=True
+)
+marker_thread.start()
+
 # ===== ADD STEP 4 HERE =====
+stop_event = threading.Event()  # Set at shutdown to wake and stop the keepalive thread
+
 def send_keepalive(outlet):
-    """Send periodic keepalive markers every 5 seconds"""
-    while True:
-        outlet.push_sample("KEEPALIVE")
-        time.sleep(5.0)
+    """Send periodic keepalive markers every 5 seconds until shutdown"""
+    while not stop_event.wait(timeout=5.0):
+        outlet.push_sample(["KEEPALIVE"])
 
 # Start keepalive thread
 keepalive_thread = threading.Thread(
@@ -148,6 +246,18 @@ keepalive_thread = threading.Thread(
 keepalive_thread.start()
 # ===== END STEP 4 ADDITION =====
 
+def stop_marker_threads():
+    """Push every queued marker, then stop the marker and keepalive threads (call before quitting)"""
+    # The consumer drains every marker queued before the sentinel, so nothing is lost on exit
+    marker_q.put(STOP_MARKER)
+    stop_event.set()
+    if marker_thread.is_alive():
+        print("Waiting for marker thread to finish...")
+        marker_thread.join(timeout=5.0)
+    if keepalive_thread.is_alive():
+        print("Waiting for keepalive thread to finish...")
+        keepalive_thread.join(timeout=2.0)
+
 # Send initialization pulses
 try:
     # First confirm the outlet exists
@@ -157,15 +267,16 @@ try:
         if not outlet.outlet:
             print("❌ Failed to create LSL outlet. Continuing without LSL markers.")
     
-    # Send initialization codes with logging
+    # Send initialization codes with logging; pushed synchronously (not queued) so the
+    # results below reflect actual delivery
     print("Sending system initialization codes...")
-    init_success = send_event_code(outlet, 900, 'SYSTEM_INIT')
+    init_success = push_event_codes(outlet, [(900, pylsl.local_clock(), 'SYSTEM_INIT')])
     core.wait(0.5)  # Add delay between critical markers
     
-    nirx_success = send_event_code(outlet, 901, 'NIRX_CONNECT')
+    nirx_success = push_event_codes(outlet, [(901, pylsl.local_clock(), 'NIRX_CONNECT')])
     core.wait(0.5)  # Add delay between critical markers
     
-    aurora_success = send_event_code(outlet, 902, 'AURORA_READY')
+    aurora_success = push_event_codes(outlet, [(902, pylsl.local_clock(), 'AURORA_READY')])
     
     # ✅ Only proceed if all codes were sent successfully
     if init_success and nirx_success and aurora_success:
@@ -178,11 +289,21 @@ try:
 except Exception as e:
     print(f"⚠️ System initialization failed: {str(e)}")
 
-# Test LSL connection before starting experiment
+# Display dialog box for participant info
+dlg = gui.DlgFromDict(dictionary=exp_info, title='Stroop Task - HIGH CONTRAST')
+if not dlg.OK:
+    core.quit()  # Cancel was pressed
+
+# Set up the experiment window - high contrast uses black background
+win = visual.Window([800, 600], color="black", units="pix", fullscr=True)
+BLANK_FRAMES = 6  # Inter-phase blank, counted in refreshes (~100 ms at 60 Hz)
+
+# Test LSL connection before starting experiment (needs win for the failure prompt)
 print("Testing LSL connection...")
 test_success = True
 for i in range(5):
-    if not send_event_code(outlet, 800+i, f'TEST_LSL_{i}'):
+    # Pushed synchronously so the test reflects actual delivery
+    if not push_event_codes(outlet, [(800+i, pylsl.local_clock(), f'TEST_LSL_{i}')]):
         test_success = False
         break
     core.wait(0.1)
@@ -202,14 +323,6 @@ else:
     if "q" in keys:
         win.close()
         core.quit()
-    
-# Display dialog box for participant info
-dlg = gui.DlgFromDict(dictionary=exp_info, title='Stroop Task - HIGH CONTRAST')
-if not dlg.OK:
-    core.quit()  # Cancel was pressed
-
-# Set up the experiment window - high contrast uses black background
-win = visual.Window([800, 600], color="black", units="pix", fullscr=True)
 
 # Define text for Stroop stimuli
 stroop_text = {
@@ -261,74 +374,97 @@ incongruent_conditions = conditions[conditions["congruent"] == 0]
 # Set up files to save results
 raw_data_file = f"stroop_high_contrast_raw_{exp_info['participant']}_{exp_info['session']}.csv"
 summary_data_file = f"stroop_high_contrast_summary_{exp_info['participant']}_{exp_info['session']}.csv"
-results = []
+
+# Raw trial data is streamed to disk as each trial ends, so a crash loses at most one trial
+raw_f = open(raw_data_file, 'w', newline='')
+raw_writer = csv.DictWriter(raw_f, fieldnames=[
+    "participant", "session", "block", "contrast", "block_type",
+    "stimulus", "response", "correct", "rt"
+])
+raw_writer.writeheader()
+
+def write_raw_row(row):
+    raw_writer.writerow(row)
+    raw_f.flush()
+
+@dataclass
+class TrialStats:
+    """Running totals for one block type, so summaries never rescan the trials"""
+    n: int = 0
+    n_correct: int = 0
+    rt_sum: float = 0.0  # Sum of RTs over correct trials only
+
+    def add(self, correct, rt):
+        self.n += 1
+        if correct:
+            self.n_correct += 1
+            self.rt_sum += rt
+
+    @property
+    def accuracy(self):
+        return self.n_correct / self.n if self.n > 0 else 0
+
+    @property
+    def mean_rt(self):
+        return self.rt_sum / self.n_correct if self.n_correct > 0 else float('nan')
+
+trial_stats = {"congruent": TrialStats(), "incongruent": TrialStats()}
 
 def check_for_escape():
     keys = event.getKeys(keyList=['escape'])
     if 'escape' in keys:
-        if results:
-            save_data(results, "partial")
+        save_data("partial")
+        stop_marker_threads()
         win.close()
         core.quit()
 
-def save_data(results_data, prefix=""):
-    raw_df = pd.DataFrame(results_data)
-    if not raw_df.empty:
-        raw_df.to_csv(f"{prefix}_{raw_data_file}", index=False)
+def save_data(prefix=""):
+    """Write the summary CSV; raw rows are already on disk via write_raw_row"""
+    # Summary comes from the running counters updated after each response
+    con = trial_stats["congruent"]
+    incon = trial_stats["incongruent"]
     
-    if len(results_data) > 0:
-        df_stroop = pd.DataFrame([r for r in results_data if r["block_type"] in ["congruent", "incongruent"]])
+    if con.n > 0 or incon.n > 0:
+        con_rt = con.mean_rt
+        incon_rt = incon.mean_rt
         
-        if not df_stroop.empty:
-            congruent_trials = df_stroop[df_stroop["block_type"] == "congruent"]
-            incongruent_trials = df_stroop[df_stroop["block_type"] == "incongruent"]
-            
-            con_correct = sum(1 for r in congruent_trials.itertuples() if r.correct == True)
-            incon_correct = sum(1 for r in incongruent_trials.itertuples() if r.correct == True)
-            
-            con_correct_trials = congruent_trials[congruent_trials["correct"] == True]
-            incon_correct_trials = incongruent_trials[incongruent_trials["correct"] == True]
-            
-            con_rt = con_correct_trials["rt"].mean() if not con_correct_trials.empty else float('nan')
-            incon_rt = incon_correct_trials["rt"].mean() if not incon_correct_trials.empty else float('nan')
-            
-            stroop_effect = incon_rt - con_rt if not (pd.isna(incon_rt) or pd.isna(con_rt)) else float('nan')
-            
-            summary_data = {
-                "measure": [
-                    "participant_id",
-                    "session",
-                    "contrast_condition",
-                    "congruent_trials_total",
-                    "incongruent_trials_total",
-                    "congruent_correct",
-                    "incongruent_correct",
-                    "congruent_accuracy",
-                    "incongruent_accuracy",
-                    "congruent_mean_rt",
-                    "incongruent_mean_rt",
-                    "stroop_effect"
-                ],
-                "value": [
-                    exp_info['participant'],
-                    exp_info['session'],
-                    "high",
-                    len(congruent_trials),
-                    len(incongruent_trials),
-                    con_correct,
-                    incon_correct,
-                    con_correct / len(congruent_trials) if len(congruent_trials) > 0 else 0,
-                    incon_correct / len(incongruent_trials) if len(incongruent_trials) > 0 else 0,
-                    con_rt,
-                    incon_rt,
-                    stroop_effect
-                ]
-            }
-            
-            summary_df = pd.DataFrame(summary_data)
-            summary_df.to_csv(f"{prefix}_{summary_data_file}", index=False)
-            
-            return con_rt, incon_rt, stroop_effect
+        stroop_effect = incon_rt - con_rt if not (pd.isna(incon_rt) or pd.isna(con_rt)) else float('nan')
+        
+        summary_data = {
+            "measure": [
+                "participant_id",
+                "session",
+                "contrast_condition",
+                "congruent_trials_total",
+                "incongruent_trials_total",
+                "congruent_correct",
+                "incongruent_correct",
+                "congruent_accuracy",
+                "incongruent_accuracy",
+                "congruent_mean_rt",
+                "incongruent_mean_rt",
+                "stroop_effect"
+            ],
+            "value": [
+                exp_info['participant'],
+                exp_info['session'],
+                "high",
+                con.n,
+                incon.n,
+                con.n_correct,
+                incon.n_correct,
+                con.accuracy,
+                incon.accuracy,
+                con_rt,
+                incon_rt,
+                stroop_effect
+            ]
+        }
+        
+        summary_df = pd.DataFrame(summary_data)
+        summary_df.to_csv(f"{prefix}_{summary_data_file}", index=False)
+        
+        return con_rt, incon_rt, stroop_effect
     
     return None, None, None
 
@@ -336,16 +472,18 @@ def save_data(results_data, prefix=""):
 instructions1 = visual.TextStim(win, text="Welcome to the Stroop Task!\n\nIn this task, you will see color words presented in different colors.\n\nYour task is to respond to the COLOR of the text, not the word itself.\n\nPress space to continue. (Press escape at any time to exit)", color="white", wrapWidth=700)
 instructions1.draw()
 win.flip()
-event.waitKeys(keyList=["space", "escape"])
-if event.getKeys(keyList=["escape"]):
+keys = event.waitKeys(keyList=["space", "escape"])
+if "escape" in keys:
+    stop_marker_threads()
     win.close()
     core.quit()
 
 instructions2 = visual.TextStim(win, text="Press:\nR = Red\nG = Green\nB = Blue\nY = Yellow\n\nYou will complete the HIGH CONTRAST version of this task.\n\nThere will be neutral screens between blocks.\n\nPress space to start. (Press escape at any time to exit)", color="white", wrapWidth=700)
 instructions2.draw()
 win.flip()
-event.waitKeys(keyList=["space", "escape"])
-if event.getKeys(keyList=["escape"]):
+keys = event.waitKeys(keyList=["space", "escape"])
+if "escape" in keys:
+    stop_marker_threads()
     win.close()
     core.quit()
     
@@ -368,25 +506,34 @@ def create_stroop_stimulus(stimulus_code):
         pos=[0, 0]
     )
 
-def run_congruent_block(block_num, num_trials=8):
-    block_results = []
-    block_trials = congruent_conditions.sample(n=num_trials, replace=True).to_dict(orient="records")
-    
+# Build all 16 Stroop stimuli once, so no TextStim is created between fixation and onset
+STIM_CACHE = {code: create_stroop_stimulus(code) for code in conditions["stimulus"]}
+
+# Marker descriptions built once, so the trial loop does no string formatting
+TRIAL_DESC = {code: f'trial_start_{code}' for code in conditions["stimulus"]}
+RESP_DESC = {
+    (key, correct): f'response_{key}_{"correct" if correct else "incorrect"}'
+    for key in "rgby" for correct in (True, False)
+}
+
+def run_congruent_block(block_num, block_trials):
     for trial in block_trials:
-        # Fixation cross
-        fixation.draw()
+        # Fixation cross, drawn by autoDraw on this one flip only; autoDraw is switched off
+        # again before the clear-screen flip, which blanks it
+        fixation.autoDraw = True
         win.flip()
         core.wait(0.2)
+        fixation.autoDraw = False
         check_for_escape()
         
-        # Clear screen
-        win.flip()
-        core.wait(0.1)
+        # Clear screen, timed by frame count so the blank is locked to the refresh
+        for _ in range(BLANK_FRAMES):
+            win.flip()
         check_for_escape()
         
         # Show Stroop stimulus
-        send_event_code(outlet, 1, f'trial_start_{trial["stimulus"]}')  # Code 1 for trial start
-        stim = create_stroop_stimulus(trial["stimulus"])
+        send_event_code(outlet, 1, TRIAL_DESC[trial["stimulus"]])  # Code 1 for trial start
+        stim = STIM_CACHE[trial["stimulus"]]
         stim.draw()
         win.flip()
         
@@ -395,15 +542,14 @@ def run_congruent_block(block_num, num_trials=8):
         keys = event.waitKeys(maxWait=2, keyList=["r", "g", "b", "y", "escape"], timeStamped=clock)
         
         if keys and keys[0][0] == "escape":
-            if block_results:
-                results.extend(block_results)
-                save_data(results, "partial")
+            save_data("partial")
+            stop_marker_threads()
             win.close()
             core.quit()
         
-        # Clear screen
-        win.flip()
-        core.wait(0.1)
+        # Clear screen, timed by frame count so the blank is locked to the refresh
+        for _ in range(BLANK_FRAMES):
+            win.flip()
         check_for_escape()
         
         # Process response
@@ -411,23 +557,16 @@ def run_congruent_block(block_num, num_trials=8):
             key, rt = keys[0]
             correct = (key == trial["correct_response"])
             response_code = 2 if correct else 3  # 2=correct, 3=incorrect
-            send_event_code(outlet, response_code, f'response_{key}_{"correct" if correct else "incorrect"}')
+            send_event_code(outlet, response_code, RESP_DESC[(key, correct)])
         else:
             key, rt = "None", 2.0
             correct = False
             send_event_code(outlet, 4, 'no_response')  # Code 4 for no response
         
-        # Feedback
-        if correct:
-            correct_feedback.draw()
-        else:
-            incorrect_feedback.draw()
-        win.flip()
-        core.wait(0.5)
-        check_for_escape()
-        
-        # Save results
-        block_results.append({
+        # Summary counters and raw row are updated together, so an escape during feedback
+        # leaves both with the same trials
+        trial_stats["congruent"].add(correct, rt)
+        write_raw_row({
             "participant": exp_info['participant'],
             "session": exp_info['session'],
             "block": block_num,
@@ -438,28 +577,34 @@ def run_congruent_block(block_num, num_trials=8):
             "correct": correct, 
             "rt": rt
         })
-    
-    return block_results
+        
+        # Feedback
+        if correct:
+            correct_feedback.draw()
+        else:
+            incorrect_feedback.draw()
+        win.flip()
+        core.wait(0.5)
+        check_for_escape()
 
-def run_incongruent_block(block_num, num_trials=8):
-    block_results = []
-    block_trials = incongruent_conditions.sample(n=num_trials, replace=True).to_dict(orient="records")
-    
+def run_incongruent_block(block_num, block_trials):
     for trial in block_trials:
-        # Fixation cross
-        fixation.draw()
+        # Fixation cross, drawn by autoDraw on this one flip only; autoDraw is switched off
+        # again before the clear-screen flip, which blanks it
+        fixation.autoDraw = True
         win.flip()
         core.wait(0.2)
+        fixation.autoDraw = False
         check_for_escape()
         
-        # Clear screen
-        win.flip()
-        core.wait(0.1)
+        # Clear screen, timed by frame count so the blank is locked to the refresh
+        for _ in range(BLANK_FRAMES):
+            win.flip()
         check_for_escape()
         
         # Show Stroop stimulus
-        send_event_code(outlet, 1, f'trial_start_{trial["stimulus"]}')  # Code 1 for trial start
-        stim = create_stroop_stimulus(trial["stimulus"])
+        send_event_code(outlet, 1, TRIAL_DESC[trial["stimulus"]])  # Code 1 for trial start
+        stim = STIM_CACHE[trial["stimulus"]]
         stim.draw()
         win.flip()
         
@@ -468,15 +613,14 @@ def run_incongruent_block(block_num, num_trials=8):
         keys = event.waitKeys(maxWait=2, keyList=["r", "g", "b", "y", "escape"], timeStamped=clock)
         
         if keys and keys[0][0] == "escape":
-            if block_results:
-                results.extend(block_results)
-                save_data(results, "partial")
+            save_data("partial")
+            stop_marker_threads()
             win.close()
             core.quit()
         
-        # Clear screen
-        win.flip()
-        core.wait(0.1)
+        # Clear screen, timed by frame count so the blank is locked to the refresh
+        for _ in range(BLANK_FRAMES):
+            win.flip()
         check_for_escape()
         
         # Process response
@@ -484,23 +628,16 @@ def run_incongruent_block(block_num, num_trials=8):
             key, rt = keys[0]
             correct = (key == trial["correct_response"])
             response_code = 2 if correct else 3  # 2=correct, 3=incorrect
-            send_event_code(outlet, response_code, f'response_{key}_{"correct" if correct else "incorrect"}')
+            send_event_code(outlet, response_code, RESP_DESC[(key, correct)])
         else:
             key, rt = "None", 2.0
             correct = False
             send_event_code(outlet, 4, 'no_response')  # Code 4 for no response
         
-        # Feedback
-        if correct:
-            correct_feedback.draw()
-        else:
-            incorrect_feedback.draw()
-        win.flip()
-        core.wait(0.5)
-        check_for_escape()
-        
-        # Save results
-        block_results.append({
+        # Summary counters and raw row are updated together, so an escape during feedback
+        # leaves both with the same trials
+        trial_stats["incongruent"].add(correct, rt)
+        write_raw_row({
             "participant": exp_info['participant'],
             "session": exp_info['session'],
             "block": block_num,
@@ -511,18 +648,29 @@ def run_incongruent_block(block_num, num_trials=8):
             "correct": correct, 
             "rt": rt
         })
-    
-    return block_results
+        
+        # Feedback
+        if correct:
+            correct_feedback.draw()
+        else:
+            incorrect_feedback.draw()
+        win.flip()
+        core.wait(0.5)
+        check_for_escape()
 
 def run_neutral_block():
     duration = random.uniform(18, 22)
-    neutral_stim.draw()
+    neutral_stim.autoDraw = True
     win.flip()
     
-    start_time = core.getTime()
-    while core.getTime() - start_time < duration:
-        check_for_escape()
-        core.wait(0.1)
+    # Sleep for the whole neutral period, waking early only on escape
+    keys = event.waitKeys(maxWait=duration, keyList=['escape'])
+    if keys and 'escape' in keys:
+        save_data("partial")
+        stop_marker_threads()
+        win.close()
+        core.quit()
+    neutral_stim.autoDraw = False
     
     return duration
 
@@ -541,12 +689,21 @@ block_sequence = [
     ("incongruent", 6)
 ]
 
+# Sample every block's trials up front, so no pandas work happens between blocks
+precomputed_trials = {
+    block_num: (congruent_conditions if block_type == "congruent" else incongruent_conditions)
+        .sample(n=8, replace=True).to_dict(orient="records")
+    for block_type, block_num in block_sequence
+    if block_type != "neutral"
+}
+
 # Start message
 block_msg = visual.TextStim(win, text="Ready to begin the experiment.\n\nPress space to start.", color="white")
 block_msg.draw()
 win.flip()
-event.waitKeys(keyList=["space", "escape"])
-if event.getKeys(keyList=["escape"]):
+keys = event.waitKeys(keyList=["space", "escape"])
+if "escape" in keys:
+    stop_marker_threads()
     win.close()
     core.quit()
 
@@ -554,17 +711,17 @@ if event.getKeys(keyList=["escape"]):
 for block_type, block_num in block_sequence:
     if block_type == "congruent":
         send_event_code(outlet, 100+block_num, f'block_{block_num}_congruent_start')
-        block_results = run_congruent_block(block_num)
+        run_congruent_block(block_num, precomputed_trials[block_num])
         send_event_code(outlet, 150+block_num, f'block_{block_num}_congruent_end')
     elif block_type == "incongruent":
         send_event_code(outlet, 200+block_num, f'block_{block_num}_incongruent_start')
-        block_results = run_incongruent_block(block_num)
+        run_incongruent_block(block_num, precomputed_trials[block_num])
         send_event_code(outlet, 250+block_num, f'block_{block_num}_incongruent_end')
     elif block_type == "neutral":
         send_event_code(outlet, 300, 'neutral_block_start')  # Fixed code
         duration = run_neutral_block()
         send_event_code(outlet, 350, 'neutral_block_end')
-        results.append({
+        write_raw_row({
             "participant": exp_info['participant'],
             "session": exp_info['session'],
             "block": "neutral",
@@ -577,7 +734,8 @@ for block_type, block_num in block_sequence:
         })
 
 # Save data
-congruent_rt, incongruent_rt, stroop_effect = save_data(results)
+congruent_rt, incongruent_rt, stroop_effect = save_data()
+raw_f.close()
 
 # Display final feedback
 if congruent_rt is not None and incongruent_rt is not None and not (pd.isna(congruent_rt) or pd.isna(incongruent_rt)):
@@ -595,12 +753,9 @@ print("Shutting down LSL connection...")
 try:
     # Send final marker
     send_event_code(outlet, 999, 'EXPERIMENT_COMPLETE')
-    core.wait(1.0)  # Wait to ensure marker is sent
     
-    # Clean shutdown
-    if keepalive_thread.is_alive():
-        print("Waiting for keepalive thread to finish...")
-        keepalive_thread.join(timeout=2.0)
+    # Clean shutdown: the final marker is pushed before the outlet is torn down
+    stop_marker_threads()
         
     # Force outlet closure
     if hasattr(outlet, 'outlet') and outlet.outlet:
@@ -4,17 +4,77 @@ from pylsl import StreamInlet, resolve_byprop
 import time
 from datetime import datetime
 import csv
+import re
 import sys
-from typing import Optional, Dict, List
+from typing import Optional, List, Tuple, TextIO
+
+USE_COLOR = sys.stdout.isatty()  # No ANSI color codes when output is redirected
+DISPLAY_BATCH = 16  # Markers buffered before a console write
+
+# Column order of stored records (and of the CSV output)
+_FIELDS = ('timestamp', 'local_time', 'elapsed_seconds', 'marker_content', 'numeric_code',
+           'trial_color', 'response_key', 'response_correct', 'marker_type')
+_TIME = _FIELDS.index('local_time')
+_ELAPSED = _FIELDS.index('elapsed_seconds')
+_CONTENT = _FIELDS.index('marker_content')
+_CODE = _FIELDS.index('numeric_code')
+_TYPE = _FIELDS.index('marker_type')
+_CORRECT = _FIELDS.index('response_correct')
+CSV_FLUSH_EVERY = 64  # Records written between explicit file flushes
+
+# Trial markers end with the stimulus code (word + ink color), so the ink color is its suffix
+_COLOR_RE = re.compile(r'(red|green|blue|yellow)$')
+
+# Marker categorizers, selected by the token before the first underscore. Each returns the
+# trailing (trial_color, response_key, response_correct, marker_type) fields of the record.
+_BLOCK_TAIL = (None, None, None, 'BLOCK')
+_NEUTRAL_TAIL = (None, None, None, 'NEUTRAL')
+_EXPERIMENT_TAIL = (None, None, None, 'EXPERIMENT')
+_SYSTEM_TAIL = (None, None, None, 'SYSTEM')
+
+def _trial(marker: str, rest: str) -> Tuple:
+    m = _COLOR_RE.search(marker)
+    return (m.group(1) if m else None, None, None, 'TRIAL')
+
+def _response(marker: str, rest: str) -> Tuple:
+    key, _, outcome = rest.partition('_')
+    return (None, key or None, outcome == 'correct', 'RESPONSE')
+
+def _block(marker: str, rest: str) -> Tuple:
+    return _BLOCK_TAIL
+
+def _neutral(marker: str, rest: str) -> Tuple:
+    return _NEUTRAL_TAIL
+
+def _experiment(marker: str, rest: str) -> Tuple:
+    return _EXPERIMENT_TAIL if rest in ('start', 'end') else _SYSTEM_TAIL
+
+def _system(marker: str, rest: str) -> Tuple:
+    return _SYSTEM_TAIL
+
+_DISPATCH = {
+    'trial': _trial,
+    'response': _response,
+    'block': _block,
+    'low': _block,   # Merged design: low_/high_<type>_block_<n>_start/end
+    'high': _block,
+    'neutral': _neutral,
+    'experiment': _experiment,
+}
 
 class RobustStroopReceiver:
     def __init__(self):
         self.inlet: Optional[StreamInlet] = None
         self.session_start: float = 0
-        self.data: List[Dict] = []
+        self.data: List[Tuple] = []  # One fixed-schema tuple per marker, see _FIELDS
         self.last_code: Optional[str] = None
         self.last_code_time: float = 0
         self.pairing_window: float = 0.1  # seconds
+        self.display_buffer: List[str] = []
+        self.filename: Optional[str] = None
+        self.csv_file: Optional[TextIO] = None
+        self.csv_writer = None
+        self.unflushed: int = 0
 
     def connect_to_stream(self, timeout: float = 30) -> bool:
         """Establish connection to LSL stream with retries"""
@@ -34,6 +94,8 @@ class RobustStroopReceiver:
                 if streams:
                     self.inlet = StreamInlet(streams[0], max_buflen=360)
                     self.session_start = time.time()
+                    if self.csv_file is None:  # Keep the same file across reconnects
+                        self.open_output()
                     print(f"\n✅ Connected to source: {streams[0].source_id()}")
                     print(f"Stream created at: {datetime.fromtimestamp(streams[0].created_at()).strftime('%Y-%m-%d %H:%M:%S')}")
                     print(f"{'='*50}\n")
@@ -52,64 +114,32 @@ class RobustStroopReceiver:
         print(f"❌ Failed to connect after {timeout} seconds")
         return False
 
-    def process_marker(self, marker: str, timestamp: float) -> Dict:
-        """Categorize and extract metadata from markers"""
-        elapsed = time.time() - self.session_start
-        record = {
-            'timestamp': timestamp,
-            'local_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3],
-            'elapsed_seconds': elapsed,
-            'marker_content': marker,
-            'numeric_code': None,
-            'trial_color': None,
-            'response_key': None,
-            'response_correct': None
-        }
+    def process_marker(self, marker: str, timestamp: float) -> Tuple:
+        """Categorize and extract metadata from markers into a _FIELDS-ordered record"""
+        # One clock read per marker; local time and elapsed time are both derived from it
+        now = time.time()
+        local_time = datetime.fromtimestamp(now).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+        elapsed = now - self.session_start
+
+        head, _, rest = marker.partition('_')
 
         # Handle CODE_ markers
-        if marker.startswith('CODE_'):
-            code = marker.replace('CODE_', '')
-            self.last_code = code
-            self.last_code_time = time.time()
-            record.update({
-                'marker_type': 'CODE',
-                'numeric_code': code
-            })
-            return record
+        if head == 'CODE':
+            self.last_code = rest
+            self.last_code_time = now
+            return (timestamp, local_time, elapsed, marker, rest, None, None, None, 'CODE')
 
         # Pair with recent code if available
         paired_code = None
-        if self.last_code and (time.time() - self.last_code_time) < self.pairing_window:
+        if self.last_code and (now - self.last_code_time) < self.pairing_window:
             paired_code = self.last_code
             self.last_code = None
-            record['numeric_code'] = paired_code
-
-        # Categorize marker type
-        if 'trial_start_' in marker:
-            record['marker_type'] = 'TRIAL'
-            record['trial_color'] = next(
-                (c for c in ['red', 'green', 'blue', 'yellow'] if c in marker),
-                None
-            )
-        elif 'response_' in marker:
-            parts = marker.split('_')
-            record.update({
-                'marker_type': 'RESPONSE',
-                'response_key': parts[1] if len(parts) > 1 else None,
-                'response_correct': 'correct' in marker
-            })
-        elif 'block_' in marker:
-            record['marker_type'] = 'BLOCK'
-        elif 'neutral_block' in marker:
-            record['marker_type'] = 'NEUTRAL'
-        elif marker in ['experiment_start', 'experiment_end']:
-            record['marker_type'] = 'EXPERIMENT'
-        else:
-            record['marker_type'] = 'SYSTEM'
-
-        return record
-
-    def display_marker(self, record: Dict):
+
+        # Categorize marker type by its leading token with a single lookup
+        color, key, correct, marker_type = _DISPATCH.get(head, _system)(marker, rest)
+        return (timestamp, local_time, elapsed, marker, paired_code, color, key, correct, marker_type)
+
+    def display_marker(self, record: Tuple):
         """Color-coded console output"""
         colors = {
             'CODE': '\033[95m',      # Purple
@@ -120,32 +150,55 @@ class RobustStroopReceiver:
             'EXPERIMENT': '\033[1;97;45m'  # Bold white on purple
         }
         
-        color = colors.get(record['marker_type'], '\033[93m')  # Default yellow
-        if record['marker_type'] == 'RESPONSE':
-            color = '\033[92m' if record['response_correct'] else '\033[91m'
+        color = colors.get(record[_TYPE], '\033[93m')  # Default yellow
+        if record[_TYPE] == 'RESPONSE':
+            color = '\033[92m' if record[_CORRECT] else '\033[91m'
         
-        code_display = f"[{record['numeric_code']}] " if record['numeric_code'] else ""
-        print(f"{color}{record['local_time']} {record['elapsed_seconds']:8.3f}s  "
-              f"{record['marker_type']}: {code_display}{record['marker_content']}\033[0m")
+        code_display = f"[{record[_CODE]}] " if record[_CODE] else ""
+        line = (f"{record[_TIME]} {record[_ELAPSED]:8.3f}s  "
+                f"{record[_TYPE]}: {code_display}{record[_CONTENT]}")
+        self.display_buffer.append(f"{color}{line}\033[0m" if USE_COLOR else line)
+        if len(self.display_buffer) >= DISPLAY_BATCH:
+            self.flush_display()
+
+    def flush_display(self):
+        """Write buffered marker lines in one call"""
+        if self.display_buffer:
+            sys.stdout.write("\n".join(self.display_buffer) + "\n")
+            sys.stdout.flush()
+            self.display_buffer.clear()
+
+    def open_output(self):
+        """Open the CSV file that markers are streamed to as they arrive"""
+        self.filename = f"stroop_data_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+        self.csv_file = open(self.filename, 'w', newline='')
+        self.csv_writer = csv.writer(self.csv_file)
+        self.csv_writer.writerow(_FIELDS)
+        print(f"💾 Streaming markers to {self.filename}")
+
+    def write_row(self, row: Tuple):
+        """Append one record to the CSV, flushing every CSV_FLUSH_EVERY records"""
+        self.csv_writer.writerow(row)
+        self.unflushed += 1
+        if self.unflushed >= CSV_FLUSH_EVERY:
+            self.csv_file.flush()
+            self.unflushed = 0
 
     def save_data(self):
-        """Save collected data with comprehensive headers"""
+        """Close the streamed CSV and print summary statistics"""
+        if self.csv_file:
+            self.csv_file.close()
+            
         if not self.data:
             print("No data to save")
             return
             
-        filename = f"stroop_data_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-        print(f"\n💾 Saving {len(self.data)} markers to {filename}")
-        
-        with open(filename, 'w', newline='') as f:
-            writer = csv.DictWriter(f, fieldnames=self.data[0].keys())
-            writer.writeheader()
-            writer.writerows(self.data)
+        print(f"\n💾 Saved {len(self.data)} markers to {self.filename}")
         
         # Print summary statistics
-        trials = [d for d in self.data if d['marker_type'] == 'TRIAL']
-        responses = [d for d in self.data if d['marker_type'] == 'RESPONSE']
-        correct = sum(1 for r in responses if r['response_correct'])
+        trials = [d for d in self.data if d[_TYPE] == 'TRIAL']
+        responses = [d for d in self.data if d[_TYPE] == 'RESPONSE']
+        correct = sum(1 for r in responses if r[_CORRECT])
         
         print("\n📊 Experiment Summary:")
         print(f"Total trials: {len(trials)}")
@@ -160,13 +213,21 @@ class RobustStroopReceiver:
         try:
             while True:
                 try:
-                    # Get marker with timeout
+                    # Block for the next marker, then drain whatever else is already queued
+                    # (a nonzero pull_chunk timeout would hold markers until 128 arrive or it expires)
                     sample, timestamp = self.inlet.pull_sample(timeout=1.0)
+                    if sample is None:
+                        continue
+                    samples, timestamps = self.inlet.pull_chunk(timeout=0.0, max_samples=128)
+                    samples.insert(0, sample)
+                    timestamps.insert(0, timestamp)
                     
-                    if sample:
-                        record = self.process_marker(sample[0], timestamp)
-                        self.display_marker(record)
-                        self.data.append(record)
+                    for sample, timestamp in zip(samples, timestamps):
+                        row = self.process_marker(sample[0], timestamp)
+                        self.display_marker(row)
+                        self.data.append(row)
+                        self.write_row(row)
+                    self.flush_display()  # Show each pulled chunk right away
                         
                 except KeyboardInterrupt:
                     print("\n🛑 Stopping receiver...")
@@ -179,6 +240,7 @@ class RobustStroopReceiver:
                         break
                         
         finally:
+            self.flush_display()
             self.save_data()
             if self.inlet:
                 self.inlet.close_stream()